@@ -1,33 +1,62 @@
 from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Request
-from pydantic import BaseModel, SecretStr
-from langchain_google_genai import ChatGoogleGenerativeAI
-from browser_use import Agent
-from browser_use.browser.browser import BrowserConfig
-from browser_use.browser.context import BrowserContextConfig
+from pydantic import BaseModel, ConfigDict, SecretStr
 import os
 from dotenv import load_dotenv
 import asyncio
 from typing import Optional, Dict, Any, List
 from fastapi.middleware.cors import CORSMiddleware
 import logging
-from langchain.schema import HumanMessage
+from functools import lru_cache
+from contextlib import asynccontextmanager
 from session_manager import session_manager, get_session_manager
+from task_cache import task_cache
 import base64
 import httpx
-import json
+import orjson
+import re
 from datetime import datetime
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response, ORJSONResponse
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 load_dotenv()
 
-RAGFLOW_API = os.getenv(RAGFLOW_API)
+RAGFLOW_API = os.getenv('RAGFLOW_API')
 RAGFLOW_API_KEY = os.getenv('RAGFLOW_API_KEY')
 RAGFLOW_DATASET_ID = os.getenv('RAGFLOW_DATASET_ID')
 RAGFLOW_CHAT_ID = os.getenv('RAGFLOW_CHAT_ID')
+GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 
-app = FastAPI(title="Browser Automation API")
+RAGFLOW_URL = f"{RAGFLOW_API}/api/v1/chats/{RAGFLOW_CHAT_ID}/completions"
+RAGFLOW_SESSIONS_URL = f"{RAGFLOW_API}/api/v1/chats/{RAGFLOW_CHAT_ID}/sessions"
+RAGFLOW_HEADERS = {
+    "Authorization": f"Bearer {RAGFLOW_API_KEY}",
+    "Content-Type": "application/json"
+}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.http_client = httpx.AsyncClient(
+        follow_redirects=True,
+        verify=False,
+        http2=True,
+        timeout=httpx.Timeout(30.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    )
+    app.state.warmup_task = asyncio.create_task(warm_up())
+    app.state.cleanup_task = asyncio.create_task(session_manager.cleanup_loop())
+    
+    yield
+    
+    app.state.warmup_task.cancel()
+    app.state.cleanup_task.cancel()
+    await session_manager.close()
+    await app.state.http_client.aclose()
+
+def get_http_client(request: Request) -> httpx.AsyncClient:
+    return request.app.state.http_client
+
+app = FastAPI(title="Browser Automation API", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -37,27 +66,102 @@ app.add_middleware(
     allow_headers=["*"],  
 )
 
-llm = ChatGoogleGenerativeAI(
-    model='gemini-2.0-flash-exp',
-    api_key=SecretStr(os.getenv('GEMINI_API_KEY'))
+EXTRA_CHROMIUM_ARGS = (
+    "--disable-blink-features=AutomationControlled",
+    "--disable-features=IsolateOrigins",
+    "--disable-site-isolation-trials",
+    "--disable-web-security",
+    "--no-sandbox",
+    "--disable-infobars",
+    "--disable-dev-shm-usage",
 )
 
+BROWSER_CONTEXT_OPTIONS = {
+    "minimum_wait_page_load_time": 1.0,
+    "wait_for_network_idle_page_load_time": 3.0,
+    "maximum_wait_page_load_time": 8.0,
+    "browser_window_size": {'width': 1920, 'height': 1080},
+    "locale": 'en-US',
+    "user_agent": 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    "highlight_elements": False,
+    "viewport_expansion": 800,
+    "wait_between_actions": 1.0,
+}
+
+# The task prompt is assembled with str.join around the two dynamic parts (page context and task)
+TASK_PROMPT_PREFIX = "\nYou are a browser automation assistant. "
+TASK_PROMPT_MIDDLE = """
+Convert the following user request into clear,
+step-by-step browser instructions that an automation agent can follow.
+
+For example, if the user says "check the weather in New York", you should generate:
+"1. Go to weather.com
+2. Search for New York
+3. Find and extract the current temperature and conditions"
+
+Be precise and include all necessary details for automation.
+If the user request involves login, make sure to specify to use placeholder values that
+will be replaced by sensitive data.
+
+User Request: """
+TASK_PROMPT_SUFFIX = """
+
+Step-by-step instructions:
+"""
+
+SCREENSHOT_JPEG_QUALITY = 70
+
+CAPTCHA_RE = re.compile(r"captcha", re.IGNORECASE)
+STEP_LIST_RE = re.compile(r"\s*(?:1[.)]\s|-\s|Step\s*1)", re.IGNORECASE)
+NUMBERED_STEPS_RE = re.compile(r"^\s*\d+\.\s")
+
+@lru_cache()
+def get_llm():
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    return ChatGoogleGenerativeAI(
+        model='gemini-2.0-flash-exp',
+        api_key=SecretStr(GEMINI_API_KEY)
+    )
+
+@lru_cache()
+def get_browser_config():
+    from browser_use.browser.browser import BrowserConfig
+    from browser_use.browser.context import BrowserContextConfig
+
+    return BrowserConfig(
+        headless=True,
+        disable_security=True,
+        new_context_config=BrowserContextConfig(**BROWSER_CONTEXT_OPTIONS),
+        extra_chromium_args=list(EXTRA_CHROMIUM_ARGS),
+        _force_keep_browser_alive=True  
+    )
+
 class SensitiveField(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     key: str
     value: str
 
 class TaskRequest(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     task: str
     include_screenshot: bool = True
-    timeout: Optional[int] = 30
+    inline_screenshot: bool = True
+    clean_screenshot: bool = False
+    timeout: Optional[int] = 300
     sensitive_data: Optional[List[SensitiveField]] = None 
     new_session: bool = False
     ragflow_session_id: Optional[str] = None
 
 class TaskResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     status: str
     message: str
     screenshot: Optional[str] = None
+    screenshot_url: Optional[str] = None
     session_id: str
     current_url: Optional[str] = None
     ragflow_session_id: Optional[str] = None
@@ -67,32 +171,20 @@ class ChatRequest(BaseModel):
     session_id: Optional[str] = None
     stream: str = "true"  
 
-async def process_user_task(task: str, current_url: str = None) -> str:  
+async def process_user_task(task: str, current_url: str = None, ragflow_answer: Optional[str] = None) -> str:  
     """Process task using default LLM."""
     try:  
-        context = f"The current browser page is at URL: {current_url}. " if current_url else ""
-        prompt = f"""
-        You are a browser automation assistant. {context}
-        Convert the following user request into clear,
-        step-by-step browser instructions that an automation agent can follow.
-
-        For example, if the user says "check the weather in New York", you should generate:
-        "1. Go to weather.com
-        2. Search for New York
-        3. Find and extract the current temperature and conditions"
-
-        Be precise and include all necessary details for automation.
-        If the user request involves login, make sure to specify to use placeholder values that
-        will be replaced by sensitive data.
-
-        User Request: {task}
-
-        Step-by-step instructions:
-        """
-        messages = [HumanMessage(content=prompt)]
-        response = await llm.ainvoke(messages)
-        logger.info("Processed user task using default LLM")
-        return response.content
+        if ragflow_answer:
+            task = f"Original task: {task}\nRAGFlow understanding: {ragflow_answer}"
+
+        async def expand() -> str:
+            context = f"The current browser page is at URL: {current_url}. " if current_url else ""
+            prompt = "".join((TASK_PROMPT_PREFIX, context, TASK_PROMPT_MIDDLE, task, TASK_PROMPT_SUFFIX))
+            response = await get_llm().ainvoke(prompt)
+            logger.info("Processed user task using default LLM")
+            return response.content
+
+        return await task_cache.get_or_compute(task, current_url, expand)
 
     except Exception as e:  
         logger.error(f"Error in process_user_task: {str(e)}", exc_info=True)  
@@ -101,204 +193,235 @@ async def process_user_task(task: str, current_url: str = None) -> str:
             detail=f"Error processing task: {str(e)}"
         )
 
-async def call_ragflow_api(question: str, session_id: Optional[str] = None, stream: str = "false"):
-    """Shared function to call RAGFlow API"""
-    async with httpx.AsyncClient(follow_redirects=True, verify=False) as client:
-        request_url = f"{RAGFLOW_API}/api/v1/chats/{RAGFLOW_CHAT_ID}/completions"
-        request_headers = {
-            "Authorization": f"Bearer {RAGFLOW_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        request_body = {
-            "question": question,
-            "stream": stream
-        }
-        
-        if session_id:
-            request_body["session_id"] = session_id
+async def iter_sse_lines(response: httpx.Response):
+    """Yield the raw lines of a streamed body as bytes, including a final line with no trailing newline"""
+    buffer = b""
+    async for chunk in response.aiter_bytes():
+        buffer += chunk
+        while b"\n" in buffer:
+            line, _, buffer = buffer.partition(b"\n")
+            yield line
+    if buffer:
+        yield buffer
 
-        logger.info(f"[RAGFlow] Sending request to: {request_url}")
-        logger.info(f"[RAGFlow] Request body: {request_body}")
+async def iter_ragflow_events(client: httpx.AsyncClient, question: str, session_id: Optional[str] = None, stream: str = "true"):
+    """Yield RAGFlow `data:` frames as they arrive, stopping at the terminal frame"""
+    request_body = {
+        "question": question,
+        "stream": stream
+    }
+    
+    if session_id:
+        request_body["session_id"] = session_id
 
-        response = await client.post(
-            request_url,
-            headers=request_headers,
-            json=request_body
-        )
-        logger.info(f"[RAGFlow] Response Status: {response.status_code}")
-        logger.info(f"[RAGFlow] Raw Response: {response.text}")
+    logger.debug("[RAGFlow] Sending request to: %s", RAGFLOW_URL)
+    logger.debug("[RAGFlow] Request body: %s", request_body)
+
+    async with client.stream("POST", RAGFLOW_URL, headers=RAGFLOW_HEADERS, json=request_body) as response:
+        logger.debug("[RAGFlow] Response Status: %s", response.status_code)
         response.raise_for_status()
 
-        try:
-            lines = response.text.strip().split('\n')
-            logger.info(f"[RAGFlow] Response lines: {lines}")
-            last_valid_data = None
-            for line in lines:
-                if line.startswith('data:'):
-                    try:
-                        json_str = line[5:].strip()
-                        logger.info(f"[RAGFlow] Processing line: {json_str}")
-                        data = json.loads(json_str)
-                        if data.get('data') and data.get('data') is not True:
-                            last_valid_data = data
-                            logger.info(f"[RAGFlow] Found valid data: {data}")
-                    except json.JSONDecodeError as e:
-                        logger.error(f"[RAGFlow] JSON decode error: {str(e)}")
-                        continue
-            
-            if not last_valid_data:
-                logger.error("[RAGFlow] No valid data found in response")
-                raise HTTPException(
-                    status_code=500,
-                    detail="No valid data found in response"
-                )
-            
-            return last_valid_data
+        # Split frames in bytes; orjson parses the payload without a str decode
+        async for line in iter_sse_lines(response):
+            if not line.startswith(b"data:"):
+                continue
+            payload = line[5:].strip()
+            if not payload or payload == b"[DONE]":
+                continue
+            logger.debug("[RAGFlow] Processing line: %s", payload)
+            try:
+                data = orjson.loads(payload)
+            except orjson.JSONDecodeError as e:
+                logger.error(f"[RAGFlow] JSON decode error: {str(e)}")
+                continue
 
-        except json.JSONDecodeError as e:
-            logger.error(f"[RAGFlow] Failed to parse response: {str(e)}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Invalid response from RAGFlow API: {str(e)}"
-            )
+            yield data
+            if data.get('data') is True:
+                break
+
+async def create_ragflow_session(client: httpx.AsyncClient, name: str) -> str:
+    """Create a RAGFlow chat session and return its id, without asking a question"""
+    response = await client.post(RAGFLOW_SESSIONS_URL, headers=RAGFLOW_HEADERS, json={"name": name})
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    
+    ragflow_session_id = (data.get('data') or {}).get('id')
+    if data.get('code') != 0 or not ragflow_session_id:
+        logger.error(f"[RAGFlow] Failed to create session: {data.get('message')}")
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to get RAGFlow session ID"
+        )
+    
+    return ragflow_session_id
+
+async def call_ragflow_api(client: httpx.AsyncClient, question: str, session_id: Optional[str] = None, stream: str = "true"):
+    """Shared function to call RAGFlow API"""
+    last_valid_data = None
+    async for data in iter_ragflow_events(client, question, session_id, stream):
+        if data.get('data') and data.get('data') is not True:
+            last_valid_data = data
+            logger.debug("[RAGFlow] Found valid data: %s", data)
+    
+    if not last_valid_data:
+        logger.error("[RAGFlow] No valid data found in response")
+        raise HTTPException(
+            status_code=500,
+            detail="No valid data found in response"
+        )
+    
+    return last_valid_data
 
 @app.post("/api/execute-task", response_model=TaskResponse)
 async def execute_task(
     request: TaskRequest, 
     background_tasks: BackgroundTasks,
     session_manager = Depends(get_session_manager),
-    session_id: str = Depends(session_manager.get_session)
+    session_id: str = Depends(session_manager.get_session),
+    http_client: httpx.AsyncClient = Depends(get_http_client)
 ):
     try:
         if request.new_session:
             session_id = await session_manager.create_session()
         
         logger.info(f"Redis Session ID: {session_id}")
-        logger.info(f"RAGFlow Session ID: {request.ragflow_session_id}")
         logger.info(f"Received task: {request.task}")
         
-        if not request.ragflow_session_id:
-            ragflow_response_01 = await call_ragflow_api(
-                question=request.task,
-                session_id=None,
-                stream="false"
-            )
-            
-            if not ragflow_response_01.get('data', {}).get('session_id'):
-                raise HTTPException(
-                    status_code=500,
-                    detail="Failed to get RAGFlow session ID"
-                )
-            
-            request.ragflow_session_id = ragflow_response_01['data']['session_id']
-            logger.info(f"Got new RAGFlow session ID: {request.ragflow_session_id}")
-            
-            ragflow_response = await call_ragflow_api(
-                question=request.task,
-                session_id=request.ragflow_session_id,
-                stream="false"
-            )
-        else:
-            ragflow_response = await call_ragflow_api(
-                question=request.task,
-                session_id=request.ragflow_session_id,
-                stream="false"
-            )
-        
-        if not ragflow_response.get('data', {}).get('answer'):
-            raise HTTPException(
-                status_code=500,
-                detail="No valid response from RAGFlow"
-            )
-        
-        ragflow_answer = ragflow_response['data']['answer']
-        logger.info(f"RAGFlow response: {ragflow_answer}")
-        
         session_data = await session_manager.get_session_data(session_id)
         current_url = session_data.get("current_url")
         
-        detailed_task = await process_user_task(
-            f"Original task: {request.task}\nRAGFlow understanding: {ragflow_answer}",
-            current_url
+        # Set up the browser context while RAGFlow and the LLM are working
+        browser_task = asyncio.create_task(
+            session_manager.get_browser_context(session_id, get_browser_config())
         )
-        logger.info(f"Processed task: {detailed_task}")
         
-        browser_config = BrowserConfig(
-            headless=True,
-            disable_security=True,
-            new_context_config=BrowserContextConfig(
-                minimum_wait_page_load_time=1.0,
-                wait_for_network_idle_page_load_time=3.0,
-                maximum_wait_page_load_time=8.0,
-                browser_window_size={'width': 1920, 'height': 1080},
-                locale='en-US',
-                user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
-                highlight_elements=False,
-                viewport_expansion=800,
-                wait_between_actions=1.0,
-            ),
-            extra_chromium_args=[
-                "--disable-blink-features=AutomationControlled",
-                "--disable-features=IsolateOrigins",
-                "--disable-site-isolation-trials",
-                "--disable-web-security",
-                "--no-sandbox",
-                "--disable-infobars",
-                "--disable-dev-shm-usage",
-            ],
-            _force_keep_browser_alive=True  
-        )
+        try:
+            ragflow_session_id = request.ragflow_session_id or session_data.get("ragflow_session_id")
+            ragflow_answer = None
+            if STEP_LIST_RE.match(request.task) and len(request.task) > 60:
+                logger.info("Task is already step-by-step instructions, skipping RAGFlow and LLM")
+                detailed_task = request.task
+            else:
+                # RAGFlow sessions have their own endpoint, so only the answer call carries the question
+                if not ragflow_session_id:
+                    ragflow_session_id = await create_ragflow_session(http_client, session_id)
+                    logger.info(f"Got new RAGFlow session ID: {ragflow_session_id}")
+                logger.info(f"RAGFlow Session ID: {ragflow_session_id}")
+                
+                if ragflow_session_id != session_data.get("ragflow_session_id"):
+                    background_tasks.add_task(session_manager.queue_update, session_id, {"ragflow_session_id": ragflow_session_id})
+                
+                ragflow_response = await call_ragflow_api(
+                    http_client,
+                    question=request.task,
+                    session_id=ragflow_session_id,
+                    stream="true"
+                )
+                
+                if not ragflow_response.get('data', {}).get('answer'):
+                    raise HTTPException(
+                        status_code=500,
+                        detail="No valid response from RAGFlow"
+                    )
+                
+                ragflow_answer = ragflow_response['data']['answer']
+                logger.debug("RAGFlow response: %s", ragflow_answer)
+                
+                if NUMBERED_STEPS_RE.match(ragflow_answer):
+                    logger.info("RAGFlow answer is already step-by-step instructions, skipping LLM")
+                    detailed_task = ragflow_answer
+                else:
+                    detailed_task = await process_user_task(request.task, current_url, ragflow_answer)
+            logger.info(f"Processed task: {detailed_task}")
+            
+            browser_context = await browser_task
+        except BaseException:
+            # Don't leave context setup running, or its error unretrieved, for a request that already failed
+            browser_task.cancel()
+            await asyncio.gather(browser_task, return_exceptions=True)
+            raise
         
-        browser = await session_manager.get_browser(session_id, browser_config)
-        sensitive_data_dict = {}
-        if request.sensitive_data:
-            sensitive_data_dict = {field.key: field.value for field in request.sensitive_data}
+        sensitive_data_dict = {field.key: field.value for field in request.sensitive_data} if request.sensitive_data else None
         
+        from browser_use import Agent
+
         agent = Agent(
             task=detailed_task,
-            llm=llm,
-            browser=browser,
+            llm=get_llm(),
+            browser=browser_context.browser,
+            browser_context=browser_context,
             sensitive_data=sensitive_data_dict
         )
         
         logger.info("Starting task execution")
-        history = await agent.run()
+        try:
+            history = await asyncio.wait_for(agent.run(), timeout=request.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Task execution timed out after {request.timeout}s")
+            return TaskResponse(
+                status="timeout",
+                message=f"Task execution timed out after {request.timeout} seconds",
+                session_id=session_id,
+                current_url=current_url or None,
+                ragflow_session_id=ragflow_session_id
+            )
         logger.info("Task execution completed successfully")
         
-        if hasattr(browser, 'context') and browser.context and browser.context.pages:
-            logger.info(f"Keeping {len(browser.context.pages)} browser pages active after task")
+        if browser_context.session and browser_context.session.context.pages:
+            logger.info(f"Keeping {len(browser_context.session.context.pages)} browser pages active after task")
         
         screenshot = None
+        screenshot_url = None
         result_message = "Task execution completed"
         new_url = None
         
-        if history.history and len(history.history) > 0:
+        if history.history:
             last_history = history.history[-1]
+            state = getattr(last_history, 'state', None)
             
-            if hasattr(last_history, 'state') and hasattr(last_history.state, 'url'):
-                new_url = last_history.state.url
-                await session_manager.update_session(session_id, {"current_url": new_url})
+            new_url = getattr(state, 'url', None)
+            if new_url is not None:
+                background_tasks.add_task(session_manager.queue_update, session_id, {"current_url": new_url})
             
             if request.include_screenshot:
-                try:
-                    clean_screenshot = await get_clean_screenshot(session_id, True, session_manager)
-                    screenshot = clean_screenshot["screenshot"]
-                except Exception as e:
-                    logger.error(f"Failed to get clean screenshot: {str(e)}")
-                    if hasattr(last_history, 'state') and last_history.state.screenshot:
-                        screenshot = last_history.state.screenshot
+                # The agent already captured the final page; only re-render it when a highlight-free copy is asked for
+                screenshot_b64 = None
+                screenshot_bytes = None
+                media_type = "image/png"
+                if request.clean_screenshot:
+                    try:
+                        screenshot_bytes = await capture_clean_screenshot(session_id, True, session_manager, image_type="jpeg")
+                        media_type = "image/jpeg"
+                    except Exception as e:
+                        logger.error(f"Failed to get clean screenshot: {str(e)}")
+                
+                if screenshot_bytes is None:
+                    screenshot_b64 = getattr(state, 'screenshot', None)
+                    if screenshot_b64:
+                        screenshot_bytes = await asyncio.to_thread(base64.b64decode, screenshot_b64)
+                
+                if screenshot_bytes:
+                    screenshot_id = session_manager.store_screenshot(session_id, screenshot_bytes, media_type)
+                    if screenshot_id:
+                        # The session id in the path lets a sticky proxy route the fetch to this worker
+                        screenshot_url = f"/screenshots/{session_id}/{screenshot_id}"
+                    if request.inline_screenshot:
+                        screenshot = screenshot_b64 or await asyncio.to_thread(
+                            lambda: base64.b64encode(screenshot_bytes).decode('ascii')
+                        )
             
-            if hasattr(last_history, 'result') and last_history.result and len(last_history.result) > 0:
-                last_result = history.history[-1].result[-1]
-                if hasattr(last_result, 'extracted_content') and last_result.extracted_content:
-                    result_message = last_result.extracted_content
+            last_results = getattr(last_history, 'result', None)
+            if last_results:
+                extracted_content = getattr(last_results[-1], 'extracted_content', None)
+                if extracted_content:
+                    result_message = extracted_content
             
-            for hist in history.history:
-                if hasattr(hist, 'eval') and hist.eval:
-                    eval_text = getattr(hist.eval, 'text', '')
-                    if eval_text and ('captcha' in eval_text.lower() or 'recaptcha' in eval_text.lower()):
-                        result_message = "Note: A CAPTCHA was detected during the task. " + result_message
-                        break
+            # CAPTCHAs almost always surface on the final steps, so scan newest first
+            if any(
+                CAPTCHA_RE.search(getattr(getattr(hist, 'eval', None), 'text', '') or '')
+                for hist in reversed(history.history)
+            ):
+                result_message = "Note: A CAPTCHA was detected during the task. " + result_message
         
         background_tasks.add_task(
             session_manager.add_history,
@@ -316,9 +439,10 @@ async def execute_task(
             status="success",
             message=result_message,
             screenshot=screenshot,
+            screenshot_url=screenshot_url,
             session_id=session_id,
             current_url=new_url,
-            ragflow_session_id=request.ragflow_session_id
+            ragflow_session_id=ragflow_session_id
         )
     except Exception as e:
         logger.error(f"Error executing task: {str(e)}", exc_info=True)
@@ -327,36 +451,31 @@ async def execute_task(
             detail=f"Error executing task: {str(e)}"
         )
 
-async def get_clean_screenshot(
+async def capture_clean_screenshot(
     session_id: str,
     full_page: bool = True,
-    session_manager = Depends(get_session_manager)
-):
-    """Get a clean screenshot without highlights"""
+    session_manager = Depends(get_session_manager),
+    image_type: str = "png"
+) -> bytes:
+    """Capture a clean PNG (or JPEG) screenshot without highlights"""
     try:
-        session_data = await session_manager.get_session_data(session_id)
-        browser_id = session_data.get("browser_id")
-        
-        if not browser_id or browser_id not in session_manager.browsers:
+        context = session_manager.get_active_context(session_id)
+        if context is None:
             raise HTTPException(status_code=404, detail="No active browser for this session")
         
-        browser = session_manager.browsers[browser_id]
-        
-        if not hasattr(browser, 'playwright_browser') or not browser.playwright_browser:
-            await browser.get_playwright_browser()
-        
-        page = browser.playwright_browser.contexts[0].pages[0] if browser.playwright_browser.contexts else None
-        if not page:
+        # An unopened context has no page yet; don't open one just to screenshot it
+        if context.session is None:
             raise HTTPException(status_code=404, detail="No active page found")
         
-        await browser.context.remove_highlights()
-
+        page = await context.get_current_page()
+        await context.remove_highlights()
 
-        screenshot_bytes = await page.screenshot(full_page=full_page)
-        screenshot_base64 = base64.b64encode(screenshot_bytes).decode('utf-8')
-        
-        return {"screenshot": screenshot_base64}
+        if image_type == "jpeg":
+            return await page.screenshot(full_page=full_page, type="jpeg", quality=SCREENSHOT_JPEG_QUALITY)
+        return await page.screenshot(full_page=full_page)
                 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error capturing clean screenshot: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
@@ -367,32 +486,93 @@ async def get_clean_screenshot_endpoint(
     full_page: bool = True,
     session_manager = Depends(get_session_manager)
 ):
-    """Endpoint to get a clean screenshot of the current page"""
-    return await get_clean_screenshot(session_id, full_page, session_manager)
+    """Endpoint to get a clean screenshot of the current page as a JPEG image"""
+    screenshot_bytes = await capture_clean_screenshot(session_id, full_page, session_manager, image_type="jpeg")
+    return Response(content=screenshot_bytes, media_type="image/jpeg")
+
+@app.get("/api/v1/session/{session_id}/clean-screenshot/raw")
+async def get_raw_clean_screenshot_endpoint(
+    session_id: str,
+    full_page: bool = True,
+    session_manager = Depends(get_session_manager)
+):
+    """Endpoint to get a clean screenshot of the current page as a PNG image"""
+    screenshot_bytes = await capture_clean_screenshot(session_id, full_page, session_manager)
+    return Response(content=screenshot_bytes, media_type="image/png")
+
+@app.get("/screenshots/{session_id}/{screenshot_id}")
+async def get_screenshot_endpoint(
+    session_id: str,
+    screenshot_id: str,
+    session_manager = Depends(get_session_manager)
+):
+    """Endpoint to fetch a screenshot captured by a previous task"""
+    screenshot, media_type = session_manager.get_screenshot(session_id, screenshot_id)
+    return Response(content=screenshot, media_type=media_type)
 
 @app.post("/api/v1/ragflow/completions")
-async def ragflow_completions(request: ChatRequest):
+async def ragflow_completions(
+    request: ChatRequest,
+    http_client: httpx.AsyncClient = Depends(get_http_client)
+):
     try:
-        logger.info(f"[RAGFlow] Request details:")
-        logger.info(f"[RAGFlow] - Session ID: {request.session_id}")
-        logger.info(f"[RAGFlow] - Question: {request.question}")
-        logger.info(f"[RAGFlow] - Stream: {request.stream}")
+        logger.debug(
+            "[RAGFlow] Request details: session_id=%s, question=%s, stream=%s",
+            request.session_id, request.question, request.stream
+        )
 
-        response = await call_ragflow_api(
+        if request.stream != "true":
+            return await call_ragflow_api(
+                http_client,
+                question=request.question,
+                session_id=request.session_id,
+                stream=request.stream
+            )
+
+        events = iter_ragflow_events(
+            http_client,
             question=request.question,
             session_id=request.session_id,
             stream=request.stream
         )
-        return response
+        try:
+            first_event = await events.__anext__()
+        except StopAsyncIteration:
+            raise HTTPException(status_code=500, detail="No valid data found in response")
+
+        async def relay():
+            try:
+                yield b"data: " + orjson.dumps(first_event) + b"\n\n"
+                async for event in events:
+                    yield b"data: " + orjson.dumps(event) + b"\n\n"
+            finally:
+                await events.aclose()
+
+        return StreamingResponse(relay(), media_type="text/event-stream")
 
     except Exception as e:
         logger.error(f"[RAGFlow] Error in completions: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def warm_up():
+    """Import the LLM and browser stacks and fill the browser pool without delaying readiness"""
+    try:
+        await asyncio.to_thread(get_llm)
+        config = await asyncio.to_thread(get_browser_config)
+        await session_manager.browser_pool.start(config)
+        await asyncio.to_thread(task_cache.get_semantic_cache)
+    except Exception as e:
+        logger.error(f"Error during warm-up: {str(e)}", exc_info=True)
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if sys.platform != "win32":
+        uvicorn.run("api:app", host="0.0.0.0", port=8000, workers=workers, loop="uvloop", http="httptools")
+    else:
+        uvicorn.run("api:app", host="0.0.0.0", port=8000, workers=workers)
\ No newline at end of file
@@ -161,6 +161,7 @@ const Chat: React.FC = () => {
         {
           task: userMessage,
           include_screenshot: includeScreenshot,
+          inline_screenshot: false,
           sensitive_data: sensitiveData,
           session_id: sessionId,
           ragflow_session_id: ragflowSessionId
@@ -192,7 +193,9 @@ const Chat: React.FC = () => {
           setMessages(prev => [...prev, { 
             role: 'assistant',
             content: response.data.message,
-            screenshot: response.data.screenshot
+            screenshot: response.data.screenshot_url
+              ? `http://localhost:8081${response.data.screenshot_url}`
+              : undefined
           }]);
         }
 
@@ -244,16 +247,19 @@ const Chat: React.FC = () => {
     try {
       setIsLoading(true);
       const response = await axios.get(`http://localhost:8081/api/v1/session/${sessionId}/clean-screenshot`, {
-        headers: { 'X-Session-ID': sessionId }
+        headers: { 'X-Session-ID': sessionId },
+        responseType: 'blob'
       });
       
-      if (response.data && response.data.screenshot) {
+      if (response.data && response.data.size) {
+        const url = URL.createObjectURL(response.data);
         const link = document.createElement('a');
-        link.href = `data:image/png;base64,${response.data.screenshot}`;
-        link.download = `screenshot_${new Date().toISOString().replace(/:/g, '-')}.png`;
+        link.href = url;
+        link.download = `screenshot_${new Date().toISOString().replace(/:/g, '-')}.jpg`;
         document.body.appendChild(link);
         link.click();
         document.body.removeChild(link);
+        URL.revokeObjectURL(url);
       }
     } catch (error) {
       console.error("Error getting clean screenshot:", error);
@@ -307,7 +313,7 @@ const Chat: React.FC = () => {
                   {message.screenshot && !message.isTyping && (
                     <div className="message-screenshot">
                       <img 
-                        src={`data:image/png;base64,${message.screenshot}`} 
+                        src={message.screenshot} 
                         alt="Screenshot of task result" 
                         loading="lazy"
                       />
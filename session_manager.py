@@ -1,81 +1,253 @@
 from fastapi import Header, HTTPException, Depends
-import redis
+import asyncio
+import logging
+import os
+import redis.asyncio
 import json
+import time
 import uuid
-from datetime import datetime, timedelta
-from typing import Dict, Optional, Any
-from browser_use.browser.browser import Browser
+from typing import TYPE_CHECKING, Dict, Optional, Any, Tuple
 from functools import lru_cache
+from cachetools import TTLCache
+
+if TYPE_CHECKING:
+    from browser_use.browser.browser import Browser
+    from browser_use.browser.context import BrowserContext
+
+logger = logging.getLogger(__name__)
 
 REDIS_URL = "redis://redis:6379/0"
 SESSION_TIMEOUT = 1800  
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "2"))
+BROWSER_POOL_MAX = int(os.getenv("BROWSER_POOL_MAX", str(os.cpu_count() or 1)))
+CONTEXTS_PER_BROWSER = int(os.getenv("CONTEXTS_PER_BROWSER", "4"))
+SCREENSHOT_CACHE_BYTES = int(os.getenv("SCREENSHOT_CACHE_BYTES", str(64 * 1024 * 1024)))
+CLEANUP_INTERVAL = 300
+UPDATE_FLUSH_DELAY = 1.0
+
+# Refresh last_active and the TTL in one round trip, only if the session still exists
+TOUCH_SESSION_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HSET', KEYS[1], 'last_active', ARGV[1])
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
 
 @lru_cache()
 def get_redis_client():
-    return redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return redis.asyncio.from_url(REDIS_URL, decode_responses=True, max_connections=50)
+
+class BrowserPool:
+    """Shares a few long-lived Chromium processes between sessions.
+
+    Each session gets its own BrowserContext (isolated cookies and storage)
+    on the least-loaded browser. Browsers beyond the pre-launched `size`
+    are only started when every running one already serves
+    CONTEXTS_PER_BROWSER contexts, and are closed again once they are idle.
+    """
+
+    def __init__(self, size: int = BROWSER_POOL_SIZE, max_size: int = BROWSER_POOL_MAX, contexts_per_browser: int = CONTEXTS_PER_BROWSER):
+        self.size = size
+        self.max_size = max(max_size, size)
+        self.contexts_per_browser = contexts_per_browser
+        self.config = None
+        self._load: Dict["Browser", int] = {}
+        self._launching = 0
+        self._lock = asyncio.Lock()
+
+    async def _launch(self) -> "Browser":
+        from browser_use.browser.browser import Browser
+
+        browser = Browser(config=self.config)
+        await browser.get_playwright_browser()
+        return browser
+
+    async def start(self, config):
+        self.config = config
+        results = await asyncio.gather(
+            *(self._launch() for _ in range(self.size - len(self._load))),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Failed to launch pooled browser: {str(result)}")
+            else:
+                self._load[result] = 0
+        logger.info(f"Browser pool started with {len(self._load)} browsers")
+
+    async def _acquire_browser(self) -> "Browser":
+        async with self._lock:
+            browser = min(self._load, key=self._load.get, default=None)
+            can_grow = len(self._load) + self._launching < self.max_size
+            if browser is not None and (self._load[browser] < self.contexts_per_browser or not can_grow):
+                self._load[browser] += 1
+                return browser
+            # Reserve the new browser's slot, then launch without holding up other acquires and releases
+            self._launching += 1
+        
+        try:
+            browser = await self._launch()
+        finally:
+            self._launching -= 1
+        self._load[browser] = 1
+        return browser
+
+    async def new_context(self, config=None) -> "BrowserContext":
+        from browser_use.browser.context import BrowserContext
+
+        if self.config is None:
+            self.config = config
+        browser = await self._acquire_browser()
+        return BrowserContext(browser=browser, config=browser.config.new_context_config)
+
+    async def release(self, context: "BrowserContext"):
+        """Close a session's context and shut its browser down if it was a burst browser left idle."""
+        browser = context.browser
+        try:
+            await context.close()
+        except Exception as e:
+            logger.error(f"Failed to close browser context: {str(e)}")
+
+        async with self._lock:
+            if browser not in self._load:
+                return
+            self._load[browser] -= 1
+            if self._load[browser] > 0 or len(self._load) <= self.size:
+                return
+            del self._load[browser]
+        await browser.close()
+
+    async def close(self):
+        browsers, self._load = list(self._load), {}
+        for browser in browsers:
+            await browser.close()
 
 class SessionManager:
     
     def __init__(self):
         self.redis = get_redis_client()
-        self.browsers = {} 
+        self._touch_session = self.redis.register_script(TOUCH_SESSION_SCRIPT)
+        self.contexts: Dict[str, "BrowserContext"] = {}
+        self.session_contexts: Dict[str, str] = {}
+        self._pending_contexts: Dict[str, asyncio.Future] = {}
+        self.browser_pool = BrowserPool()
+        # Budgeted in bytes rather than entries, since a full-page screenshot can be several MB
+        self.screenshots = TTLCache(maxsize=SCREENSHOT_CACHE_BYTES, ttl=SESSION_TIMEOUT, getsizeof=lambda v: len(v[0]))
+        self.sessions_changed = asyncio.Event()
+        self._pending_updates: Dict[str, Dict[str, Any]] = {}
+        self._flush_task = None
     
     async def get_session(self, session_id: Optional[str] = Header(None, alias="X-Session-ID")):
-        if session_id:
-            if self.redis.exists(f"session:{session_id}"):
-                self.redis.hset(f"session:{session_id}", "last_active", datetime.now().isoformat())
-                self.redis.expire(f"session:{session_id}", SESSION_TIMEOUT)  
+        if session_id and await self._touch_session(
+            keys=[f"session:{session_id}"],
+            args=[int(time.time()), SESSION_TIMEOUT]
+        ):
+            return session_id
         
         return await self.create_session()
     
     async def create_session(self) -> str:
         session_id = str(uuid.uuid4())
+        now = int(time.time())
         
-        self.redis.hset(
-            f"session:{session_id}", 
-            mapping={
-                "created_at": datetime.now().isoformat(),
-                "last_active": datetime.now().isoformat(),
-                "current_url": "",
-                "browser_id": str(uuid.uuid4())
-            }
-        )
-        
-        self.redis.expire(f"session:{session_id}", SESSION_TIMEOUT)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(
+                f"session:{session_id}", 
+                mapping={
+                    "created_at": now,
+                    "last_active": now,
+                    "current_url": "",
+                    "browser_id": str(uuid.uuid4())
+                }
+            )
+            pipe.expire(f"session:{session_id}", SESSION_TIMEOUT)
+            await pipe.execute()
         
         return session_id
     
-    async def get_browser(self, session_id: str, config=None) -> Browser:
-        browser_id = self.redis.hget(f"session:{session_id}", "browser_id")
+    def get_active_context(self, session_id: str) -> Optional["BrowserContext"]:
+        """Return the browser context this process holds for a session, without a Redis lookup."""
+        return self.contexts.get(self.session_contexts.get(session_id))
+    
+    async def get_browser_context(self, session_id: str, config=None) -> "BrowserContext":
+        context = self.get_active_context(session_id)
+        if context is not None:
+            return context
         
-        if not browser_id or browser_id not in self.browsers:
+        # Concurrent requests for the same session share one creation instead of each opening a context
+        pending = self._pending_contexts.get(session_id)
+        if pending is None:
+            pending = asyncio.ensure_future(self._create_browser_context(session_id, config))
+            self._pending_contexts[session_id] = pending
+            pending.add_done_callback(lambda _: self._pending_contexts.pop(session_id, None))
+        return await asyncio.shield(pending)
+    
+    async def _create_browser_context(self, session_id: str, config=None) -> "BrowserContext":
+        browser_id = await self.redis.hget(f"session:{session_id}", "browser_id")
+        context = self.get_active_context(session_id)
+        if context is not None:
+            return context
+        
+        if not browser_id or browser_id not in self.contexts:
             if config:
                 
                 config._force_keep_browser_alive = True
             
-            browser = Browser(config=config)
-            self.browsers[browser_id] = browser
+            context = await self.browser_pool.new_context(config)
+            self.contexts[browser_id] = context
+            self.session_contexts[session_id] = browser_id
+            self.sessions_changed.set()
         
-        return self.browsers[browser_id]
+        return self.contexts[browser_id]
     
     async def update_session(self, session_id: str, data: Dict[str, Any]):
-        self.redis.expire(f"session:{session_id}", SESSION_TIMEOUT)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(f"session:{session_id}", mapping=data)
+            pipe.expire(f"session:{session_id}", SESSION_TIMEOUT)
+            await pipe.execute()
+    
+    async def queue_update(self, session_id: str, data: Dict[str, Any]):
+        """Buffer a session update; buffered updates are coalesced and written within UPDATE_FLUSH_DELAY."""
+        self._pending_updates.setdefault(session_id, {}).update(data)
+        
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+    
+    async def _flush_later(self):
+        # Updates queued while a flush is awaiting Redis see this task still running, so keep going until none are left
+        while self._pending_updates:
+            await asyncio.sleep(UPDATE_FLUSH_DELAY)
+            await self.flush_updates()
+    
+    async def flush_updates(self):
+        pending, self._pending_updates = self._pending_updates, {}
         
-        self.redis.hset(f"session:{session_id}", mapping=data)
+        for session_id, data in pending.items():
+            try:
+                await self.update_session(session_id, data)
+            except Exception as e:
+                logger.error(f"Failed to flush update for session {session_id}: {str(e)}")
     
     async def add_history(self, session_id: str, history_item: Dict[str, Any]):
         history_key = f"history:{session_id}"
         
-        history_item["timestamp"] = datetime.now().isoformat()
-        self.redis.rpush(history_key, json.dumps(history_item))
-        
-        self.redis.expire(history_key, SESSION_TIMEOUT)
+        history_item["timestamp"] = int(time.time())
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.rpush(history_key, json.dumps(history_item))
+            pipe.expire(history_key, SESSION_TIMEOUT)
+            await pipe.execute()
     
     async def get_session_data(self, session_id: str) -> Dict[str, Any]:
-        data = self.redis.hgetall(f"session:{session_id}")
+        data = await self.redis.hgetall(f"session:{session_id}")
         
         if not data:
             raise HTTPException(status_code=404, detail="Session not found")
+        
+        pending = self._pending_updates.get(session_id)
+        if pending:
+            data.update(pending)
             
         return data
     
@@ -83,29 +255,79 @@ class SessionManager:
         history_key = f"history:{session_id}"
         
         if limit > 0:
-            raw_items = self.redis.lrange(history_key, -limit, -1)
+            raw_items = await self.redis.lrange(history_key, -limit, -1)
         else:
-            raw_items = self.redis.lrange(history_key, 0, -1)
+            raw_items = await self.redis.lrange(history_key, 0, -1)
             
         return [json.loads(item) for item in raw_items]
     
-    async def clear_inactive_sessions(self):
-        for key in self.redis.keys("session:*"):
-            session_id = key.split(":", 1)[1]
-            last_active = self.redis.hget(key, "last_active")
+    def store_screenshot(self, session_id: str, screenshot: bytes, media_type: str = "image/png") -> Optional[str]:
+        if len(screenshot) > SCREENSHOT_CACHE_BYTES:
+            logger.warning(f"Screenshot of {len(screenshot)} bytes exceeds the screenshot cache budget, not storing it")
+            return None
+        
+        screenshot_id = str(uuid.uuid4())
+        self.screenshots[(session_id, screenshot_id)] = (screenshot, media_type)
+        return screenshot_id
+    
+    def get_screenshot(self, session_id: str, screenshot_id: str) -> Tuple[bytes, str]:
+        screenshot = self.screenshots.get((session_id, screenshot_id))
+        
+        if screenshot is None:
+            raise HTTPException(status_code=404, detail="Screenshot not found")
+            
+        return screenshot
+    
+    async def clear_inactive_sessions(self) -> Optional[float]:
+        """Release browser contexts of sessions Redis has expired and return the seconds until the next expiry, if any remain."""
+        await self.flush_updates()
+        session_ids = list(self.session_contexts)
+        if not session_ids:
+            return None
+        
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for session_id in session_ids:
+                pipe.pttl(f"session:{session_id}")
+            ttls = await pipe.execute()
+        
+        next_expiry = None
+        for session_id, ttl in zip(session_ids, ttls):
+            if ttl == -2:
+                browser_id = self.session_contexts.pop(session_id, None)
+                context = self.contexts.pop(browser_id, None)
+                if context:
+                    await self.browser_pool.release(context)
+                await self.redis.delete(f"history:{session_id}")
+            elif ttl > 0:
+                remaining = ttl / 1000
+                if next_expiry is None or remaining < next_expiry:
+                    next_expiry = remaining
+        
+        return next_expiry
+
+    async def cleanup_loop(self):
+        """Sweep inactive sessions, sleeping until the next expiry and idling while there are none."""
+        while True:
+            await self.sessions_changed.wait()
+            self.sessions_changed.clear()
             
-            if not last_active:
-                continue
-                
-            last_active_time = datetime.fromisoformat(last_active)
-            if datetime.now() - last_active_time > timedelta(seconds=SESSION_TIMEOUT):
-                browser_id = self.redis.hget(key, "browser_id")
-                if browser_id in self.browsers:
-                    browser = self.browsers.pop(browser_id)
-                    await browser.close()
-                
-                self.redis.delete(key)
-                self.redis.delete(f"history:{session_id}")
+            try:
+                next_expiry = await self.clear_inactive_sessions()
+            except Exception as e:
+                logger.error(f"Error clearing inactive sessions: {str(e)}")
+                next_expiry = CLEANUP_INTERVAL
+            
+            if next_expiry is not None:
+                self.sessions_changed.set()
+                await asyncio.sleep(min(max(next_expiry, 1), CLEANUP_INTERVAL))
+
+    async def close(self):
+        await self.flush_updates()
+        for context in self.contexts.values():
+            await context.close()
+        self.contexts.clear()
+        self.session_contexts.clear()
+        await self.browser_pool.close()
 
 
 session_manager = SessionManager()
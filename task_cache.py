@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Awaitable, Callable, Dict, Optional
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+TASK_CACHE_TTL = int(os.getenv("TASK_CACHE_TTL", "3600"))
+TASK_CACHE_SIZE = int(os.getenv("TASK_CACHE_SIZE", "1024"))
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "false").lower() == "true"
+SEMANTIC_CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR", "semantic_cache")
+SEMANTIC_CACHE_MAX_DISTANCE = float(os.getenv("SEMANTIC_CACHE_MAX_DISTANCE", "0.1"))
+
+def init_semantic_cache(data_dir: str = SEMANTIC_CACHE_DIR, max_distance: float = SEMANTIC_CACHE_MAX_DISTANCE):
+    """Build a GPTCache instance backed by ONNX embeddings and a FAISS index.
+
+    GPTCache and its ONNX/FAISS backends are only needed when SEMANTIC_CACHE
+    is enabled, so they are imported here rather than at module load.
+    """
+    from gptcache import Cache
+    from gptcache.embedding import Onnx
+    from gptcache.manager import CacheBase, VectorBase, get_data_manager
+    from gptcache.processor.pre import get_prompt
+    from gptcache.similarity_evaluation.distance import SearchDistanceEvaluation
+
+    os.makedirs(data_dir, exist_ok=True)
+    onnx = Onnx()
+    data_manager = get_data_manager(
+        CacheBase("sqlite", sql_url=f"sqlite:///{data_dir}/cache.db"),
+        VectorBase("faiss", dimension=onnx.dimension, index_path=f"{data_dir}/faiss.index"),
+    )
+    cache = Cache()
+    cache.init(
+        pre_embedding_func=get_prompt,
+        embedding_func=onnx.to_embeddings,
+        data_manager=data_manager,
+        similarity_evaluation=SearchDistanceEvaluation(max_distance=max_distance),
+    )
+    return cache
+
+class TaskCache:
+    """Caches LLM-expanded task instructions keyed by (task, current_url).
+
+    Exact repeats are served from an in-memory TTL cache. When a semantic
+    cache is configured, near-duplicate phrasings of the same task on the
+    same page are served from it as well.
+    """
+
+    def __init__(self, maxsize: int = TASK_CACHE_SIZE, ttl: int = TASK_CACHE_TTL, semantic: bool = SEMANTIC_CACHE):
+        self.enabled = ttl > 0
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl) if self.enabled else None
+        self._lock = asyncio.Lock()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Built on first use in a worker thread, so importing this module stays cheap
+        self._semantic_enabled = semantic
+        self._semantic = None
+        self._semantic_lock = threading.Lock()
+
+    def get_semantic_cache(self):
+        """Return the semantic cache, initialising it on first call; blocking, so call it off the event loop."""
+        with self._semantic_lock:
+            if self._semantic is None and self._semantic_enabled:
+                try:
+                    self._semantic = init_semantic_cache()
+                except Exception as e:
+                    logger.error(f"Failed to initialise semantic cache: {str(e)}")
+                    self._semantic_enabled = False
+            return self._semantic
+
+    @staticmethod
+    def semantic_prompt(task: str, current_url: Optional[str] = None) -> str:
+        # The URL is part of the embedded text so entries for other pages don't crowd out this one
+        return f"URL: {current_url or ''}\nTask: {task}"
+
+    @staticmethod
+    def make_key(task: str, current_url: Optional[str] = None) -> str:
+        return hashlib.blake2b((task + "|" + (current_url or "")).encode()).hexdigest()
+
+    async def get(self, task: str, current_url: Optional[str] = None) -> Optional[str]:
+        if self.enabled:
+            async with self._lock:
+                cached = self._cache.get(self.make_key(task, current_url))
+            if cached is not None:
+                return cached
+
+        if self._semantic_enabled:
+            return await asyncio.to_thread(self._semantic_get, task, current_url)
+        return None
+
+    async def set(self, task: str, current_url: Optional[str], value: str):
+        if self.enabled:
+            async with self._lock:
+                self._cache[self.make_key(task, current_url)] = value
+
+        if self._semantic_enabled:
+            await asyncio.to_thread(self._semantic_put, task, current_url, value)
+
+    async def get_or_compute(self, task: str, current_url: Optional[str], compute: Callable[[], Awaitable[str]]) -> str:
+        """Return cached instructions, or compute them once for all concurrent identical requests."""
+        cached = await self.get(task, current_url)
+        if cached is not None:
+            logger.info("Using cached instructions for user task")
+            return cached
+
+        key = self.make_key(task, current_url)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            logger.info("Joining in-flight expansion of identical task")
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # Only the leader was cancelled, not this request; take over the expansion
+                if not inflight.cancelled():
+                    raise
+                logger.info("In-flight expansion was cancelled, retrying it")
+                return await self.get_or_compute(task, current_url, compute)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await compute()
+            await self.set(task, current_url, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception retrieved in case no other request joined
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    def _semantic_get(self, task: str, current_url: Optional[str]) -> Optional[str]:
+        from gptcache.adapter.api import get
+
+        cache = self.get_semantic_cache()
+        if cache is None:
+            return None
+        try:
+            raw = get(self.semantic_prompt(task, current_url), cache_obj=cache)
+        except Exception as e:
+            logger.error(f"Semantic cache lookup failed: {str(e)}")
+            return None
+        if not raw:
+            return None
+
+        entry = json.loads(raw)
+        # Instructions are only valid for the page they were generated on
+        if entry.get("url") != (current_url or ""):
+            return None
+        return entry.get("instructions")
+
+    def _semantic_put(self, task: str, current_url: Optional[str], value: str):
+        from gptcache.adapter.api import put
+
+        cache = self.get_semantic_cache()
+        if cache is None:
+            return
+        try:
+            put(self.semantic_prompt(task, current_url), json.dumps({"url": current_url or "", "instructions": value}), cache_obj=cache)
+        except Exception as e:
+            logger.error(f"Semantic cache store failed: {str(e)}")
+
+
+task_cache = TaskCache()